@@ -1,182 +1,190 @@
 import os
-import json
-import requests
-import pandas as pd
-from flask import Flask, request, jsonify
+import io
+import csv
+import orjson
+import msgspec
+import uvicorn
+from uuid import uuid4
+from fastapi import FastAPI, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from datetime import datetime
-from openai import OpenAI
-from dotenv import load_dotenv
+from openpyxl import Workbook
+from rq.job import Job
+from rq.exceptions import NoSuchJobError
 
-# -----------------------------------
-# 1. Load environment variables
-# -----------------------------------
-load_dotenv()
+from worker import (
+    queue, process_call, reprocess_range, cached_report, claim_recording, release_recording, report_lock,
+    REPORT_CSV
+)
 
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-CALLYZER_KEY = os.getenv("CALLYZER_SANDBOX_API_KEY")
-CALLYZER_BASE = os.getenv("CALLYZER_BASE_URL", "https://sandbox.api.callyzer.co/api/v2.1")
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
 
-client = OpenAI(api_key=OPENAI_API_KEY)
-app = Flask(__name__)
 
-# -----------------------------------
-# 2. Helper Functions
-# -----------------------------------
+class CallWebhook(msgspec.Struct):
+    """Callyzer webhook payload (unknown fields are ignored)"""
+    call_id: str | int | None = None
+    agent_name: str | None = None
+    recording_url: str | None = None
 
-def download_recording(url, call_id):
-    """Download audio recording from Callyzer or given URL"""
-    os.makedirs("recordings", exist_ok=True)
-    file_path = f"recordings/{call_id}.mp3"
-    print(f"🎧 Downloading: {url}")
-    r = requests.get(url, stream=True)
-    r.raise_for_status()
-    with open(file_path, "wb") as f:
-        for chunk in r.iter_content(1024):
-            f.write(chunk)
-    print("✅ Recording downloaded successfully")
-    return file_path
-
-
-def transcribe_audio(audio_file):
-    """Convert speech to text using OpenAI Whisper"""
-    print(f"🔊 Transcribing: {audio_file}")
-    with open(audio_file, "rb") as f:
-        transcript = client.audio.transcriptions.create(model="whisper-1", file=f)
-    text = transcript.text
-    print("📝 Transcription complete")
-    return text
-
-
-def analyze_call(transcript):
-    """Analyze call and give QA score using GPT"""
-    print("🤖 Analyzing call...")
-    prompt = f"""
-    You are a call quality analyst. Analyze this conversation and give:
-    - Communication clarity
-    - Empathy
-    - Product knowledge
-    - Professional tone
-    Provide a JSON output with 'score' (0–100) and 'feedback'.
-
-    Transcript:
-    {transcript}
-    """
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[{"role": "system", "content": "You are an AI QA analyst."},
-                  {"role": "user", "content": prompt}]
-    )
-    result = response.choices[0].message.content
-    print("📊 Analysis complete")
-    return result
-
-
-def update_excel(call_id, agent_name, score, feedback, transcript_path):
-    """Update or create QA Excel report"""
-    os.makedirs("reports", exist_ok=True)
-    file_path = "reports/QA_Report.xlsx"
-
-    df_new = pd.DataFrame([{
-        "Date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "Call ID": call_id,
-        "Agent Name": agent_name,
-        "Score": score,
-        "Feedback": feedback,
-        "Transcript File": transcript_path
-    }])
-
-    if os.path.exists(file_path):
-        df = pd.read_excel(file_path)
-        df = pd.concat([df, df_new], ignore_index=True)
-    else:
-        df = df_new
-
-    df.to_excel(file_path, index=False)
-    print(f"📈 Excel updated → {file_path}")
-
-
-def callyzer_get(path, params=None):
-    """Optional: Pull history from Callyzer Sandbox"""
-    url = f"{CALLYZER_BASE}{path}"
-    headers = {
-        "Authorization": f"Bearer {CALLYZER_KEY}",
-        "Content-Type": "application/json"
-    }
-    r = requests.get(url, headers=headers, params=params or {}, timeout=60)
-    r.raise_for_status()
-    return r.json()
+
+app = FastAPI(title="AI-QA Bot", default_response_class=ORJSONResponse)
 
 # -----------------------------------
-# 3. Webhook Route (Main Entry)
+# 1. Webhook Route (Main Entry)
 # -----------------------------------
 
-@app.route("/callyzer-webhook", methods=["POST"])
-def handle_callyzer_webhook():
-    """Main webhook endpoint for Callyzer"""
+def queue_call(call_id, agent_name, recording_url):
+    """Answer a duplicate delivery or enqueue the QA pipeline for one recording (blocking)"""
+    # Callyzer retries redeliver the same recording — answer from the saved report
+    cached = cached_report(recording_url)
+    if cached:
+        print(f"♻️ Duplicate recording_url, returning report for {cached['call_id']}")
+        return {"status": "duplicate", **cached}
+
+    # Retries that arrive while the first job is still queued or running point at that job
+    job_id = uuid4().hex
+    existing_job_id = claim_recording(recording_url, job_id)
+    if existing_job_id:
+        print(f"♻️ Duplicate recording_url, already queued as {existing_job_id}")
+        return ORJSONResponse({"status": "duplicate", "call_id": call_id, "job_id": existing_job_id}, status_code=202)
+
     try:
-        data = request.get_json(force=True)
+        job = queue.enqueue(process_call, {
+            "call_id": call_id,
+            "agent_name": agent_name,
+            "recording_url": recording_url
+        }, job_id=job_id, job_timeout=900)
+    except Exception:
+        release_recording(recording_url)
+        raise
+
+    print(f"📬 QA job queued: {job.id}")
+    return ORJSONResponse({"status": "queued", "call_id": call_id, "job_id": job.id}, status_code=202)
+
+
+@app.post("/callyzer-webhook")
+async def handle_callyzer_webhook(request: Request):
+    """Main webhook endpoint for Callyzer — queues the QA pipeline and returns immediately"""
+    try:
+        try:
+            data = msgspec.json.decode(await request.body(), type=CallWebhook)
+        except msgspec.DecodeError as e:
+            return ORJSONResponse({"error": f"Invalid payload: {e}"}, status_code=400)
         print(f"📩 Webhook received: {data}")
 
-        call_id = data.get("call_id", f"call_{datetime.now().strftime('%H%M%S')}")
-        agent_name = data.get("agent_name", "Unknown Agent")
-        recording_url = data.get("recording_url")
+        call_id = str(data.call_id) if data.call_id is not None else f"call_{datetime.now().strftime('%H%M%S')}"
+        agent_name = data.agent_name or "Unknown Agent"
+        recording_url = data.recording_url
 
         if not recording_url:
-            return jsonify({"error": "Missing recording_url"}), 400
+            return ORJSONResponse({"error": "Missing recording_url"}, status_code=400)
 
-        # Step 1: Download recording
-        audio_file = download_recording(recording_url, call_id)
+        # Redis and disk calls block: run them in FastAPI's threadpool, off the event loop
+        return await run_in_threadpool(queue_call, call_id, agent_name, recording_url)
 
-        # Step 2: Transcribe
-        transcript_text = transcribe_audio(audio_file)
+    except Exception as e:
+        print("❌ Error:", e)
+        return ORJSONResponse({"error": str(e)}, status_code=500)
 
-        # Step 3: Analyze
-        analysis = analyze_call(transcript_text)
 
-        # Step 4: Parse score + feedback from GPT output
-        try:
-            parsed = json.loads(analysis)
-            score = parsed.get("score", "N/A")
-            feedback = parsed.get("feedback", "")
-        except:
-            score = "N/A"
-            feedback = analysis
-
-        # Step 5: Save transcript & report
-        os.makedirs("transcripts", exist_ok=True)
-        transcript_path = f"transcripts/{call_id}.txt"
-        with open(transcript_path, "w", encoding="utf-8") as f:
-            f.write(transcript_text)
-
-        os.makedirs("qa_reports", exist_ok=True)
-        report_path = f"qa_reports/{call_id}.json"
-        with open(report_path, "w", encoding="utf-8") as f:
-            json.dump({"score": score, "feedback": feedback}, f, indent=2, ensure_ascii=False)
-
-        # Step 6: Update Excel
-        update_excel(call_id, agent_name, score, feedback, transcript_path)
-
-        print(f"✅ QA Report Generated: {call_id}")
-        return jsonify({"status": "success", "call_id": call_id, "score": score, "feedback": feedback})
+# -----------------------------------
+# 2. Job Status Route
+# -----------------------------------
 
-    except Exception as e:
-        print("❌ Error:", e)
-        return jsonify({"error": str(e)}), 500
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    """Check progress of a queued QA job (sync: FastAPI runs it in a thread)"""
+    try:
+        job = Job.fetch(job_id, connection=queue.connection)
+    except NoSuchJobError:
+        return ORJSONResponse({"error": "Unknown job_id"}, status_code=404)
+
+    status = job.get_status()
+    payload = {"job_id": job.id, "status": status}
+    if status == "finished":
+        payload["result"] = job.result
+    elif status == "failed":
+        payload["error"] = job.exc_info.strip().splitlines()[-1] if job.exc_info else "Job failed"
+    return payload
+
+
+# -----------------------------------
+# 3. Admin Reprocess Route
+# -----------------------------------
+
+@app.post("/reprocess-range")
+async def reprocess_range_route(request: Request):
+    """Queue a batch re-run of QA for historical Callyzer calls"""
+    if not ADMIN_TOKEN or request.headers.get("X-Admin-Token") != ADMIN_TOKEN:
+        return ORJSONResponse({"error": "Forbidden"}, status_code=403)
+
+    try:
+        data = orjson.loads(await request.body())
+    except orjson.JSONDecodeError as e:
+        return ORJSONResponse({"error": f"Invalid payload: {e}"}, status_code=400)
+    if not isinstance(data, dict):
+        return ORJSONResponse({"error": "Invalid payload: expected a JSON object"}, status_code=400)
+
+    start_date = data.get("start_date")
+    end_date = data.get("end_date")
+    if not start_date or not end_date:
+        return ORJSONResponse({"error": "Missing start_date or end_date"}, status_code=400)
+
+    job = await run_in_threadpool(queue.enqueue, reprocess_range, start_date, end_date, job_timeout=3600)
+    print(f"📬 Reprocess job queued: {job.id}")
+    return ORJSONResponse({"status": "queued", "job_id": job.id}, status_code=202)
+
+
+# -----------------------------------
+# 4. Excel Export Route
+# -----------------------------------
+
+@app.get("/export-xlsx")
+def export_xlsx(request: Request):
+    """Build QA_Report.xlsx from the CSV log on demand (sync: FastAPI runs it in a thread)"""
+    if not ADMIN_TOKEN or request.headers.get("X-Admin-Token") != ADMIN_TOKEN:
+        return ORJSONResponse({"error": "Forbidden"}, status_code=403)
+
+    if not os.path.exists(REPORT_CSV):
+        return ORJSONResponse({"error": "No QA report rows yet"}, status_code=404)
+
+    # Snapshot under the report lock so a row being appended is never read half-written
+    with report_lock(), open(REPORT_CSV, newline="", encoding="utf-8") as f:
+        snapshot = f.read()
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("QA Report")
+    for i, row in enumerate(csv.reader(io.StringIO(snapshot))):
+        if i > 0 and row[3].isdigit():
+            row[3] = int(row[3])
+        ws.append(row)
+
+    buf = io.BytesIO()
+    wb.save(buf)
+    buf.seek(0)
+    return StreamingResponse(
+        buf,
+        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        headers={"Content-Disposition": 'attachment; filename="QA_Report.xlsx"'}
+    )
 
 
 # -----------------------------------
-# 4. Test Route (to verify online hosting)
+# 5. Test Route (to verify online hosting)
 # -----------------------------------
 
-@app.route("/", methods=["GET"])
-def home():
-    return jsonify({"message": "AI-QA Bot Live ✅", "time": datetime.now().isoformat()})
+@app.get("/")
+async def home():
+    return {"message": "AI-QA Bot Live ✅", "time": datetime.now().isoformat()}
 
 
 # -----------------------------------
-# 5. Run App
+# 6. Run App
 # -----------------------------------
 
+# Production: run via the Procfile (gunicorn + uvicorn workers).
+# `python app.py` is for local use; APP_ENV=dev turns on auto-reload.
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
-    app.run(host="0.0.0.0", port=port, debug=True)
+    uvicorn.run("app:app", host="0.0.0.0", port=port, reload=os.getenv("APP_ENV") == "dev")
@@ -0,0 +1,546 @@
+"""
+Background QA pipeline for Callyzer calls.
+
+The webhook in app.py only enqueues jobs; the heavy lifting
+(download → Whisper → GPT → Excel) runs here, inside an RQ worker:
+
+    rq worker --url $REDIS_URL --worker-class rq.worker.SimpleWorker
+
+SimpleWorker runs jobs in-process, so loaded models and pooled clients
+live across jobs. Scale by starting more worker processes.
+"""
+
+import os
+import io
+import csv
+import time
+import orjson
+import fcntl
+import asyncio
+import hashlib
+import threading
+import functools
+import httpx
+import zstandard as zstd
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from openai import AsyncOpenAI
+from dotenv import load_dotenv
+from redis import Redis
+from rq import Queue
+
+from rubric import QA_RUBRIC
+
+# -----------------------------------
+# 1. Load environment variables
+# -----------------------------------
+load_dotenv()
+
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+CALLYZER_KEY = os.getenv("CALLYZER_SANDBOX_API_KEY")
+CALLYZER_BASE = os.getenv("CALLYZER_BASE_URL", "https://sandbox.api.callyzer.co/api/v2.1")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+ANALYSIS_CACHE_DIR = os.getenv("ANALYSIS_CACHE_DIR", "cache/analysis")
+ANALYSIS_CACHE_TTL_DAYS = float(os.getenv("ANALYSIS_CACHE_TTL_DAYS", 30))
+ANALYSIS_MODEL = "gpt-4o-mini"
+CALLYZER_HISTORY_PATH = os.getenv("CALLYZER_HISTORY_PATH", "/call-log/history")
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", 32))
+SAVE_RECORDINGS = os.getenv("SAVE_RECORDINGS") == "1"
+
+# Transcription backend: "openai" (Whisper API) or "local" (self-hosted faster-whisper)
+TRANSCRIBE_BACKEND = os.getenv("TRANSCRIBE_BACKEND", "openai")
+WHISPER_MODEL = os.getenv("WHISPER_MODEL", "large-v3")
+WHISPER_DEVICE = os.getenv("WHISPER_DEVICE", "cuda")
+WHISPER_COMPUTE_TYPE = os.getenv("WHISPER_COMPUTE_TYPE", "int8_float16")
+WHISPER_BATCH_SIZE = int(os.getenv("WHISPER_BATCH_SIZE", 8))
+TRANSCRIBE_CONCURRENCY = int(os.getenv("TRANSCRIBE_CONCURRENCY", 8))
+REPROCESS_BATCH_SIZE = int(os.getenv("REPROCESS_BATCH_SIZE", TRANSCRIBE_CONCURRENCY * 4))
+
+# Optional local scorer for short calls (llama.cpp GGUF model); unset to always use OpenAI
+LOCAL_LLM_PATH = os.getenv("LOCAL_LLM_PATH")
+LOCAL_LLM_MAX_WORDS = int(os.getenv("LOCAL_LLM_MAX_WORDS", 400))
+
+REPORT_CSV = "reports/QA_Report.csv"
+LEGACY_REPORT_XLSX = "reports/QA_Report.xlsx"
+# Finished results keyed by recording URL, and how long a queued/running job holds its URL in Redis
+RECORDING_REPORTS_DIR = "recording_reports"
+DEDUPE_CLAIM_SECONDS = int(os.getenv("DEDUPE_CLAIM_SECONDS", 86400))
+REPORT_COLUMNS = ["Date", "Call ID", "Agent Name", "Score", "Feedback", "Transcript File"]
+
+# Structured output schema: the model must return exactly {score, feedback}
+QA_SCHEMA = {
+    "type": "object",
+    "required": ["score", "feedback"],
+    "additionalProperties": False,
+    "properties": {
+        "score": {"type": "integer", "minimum": 0, "maximum": 100},
+        "feedback": {"type": "string"}
+    }
+}
+
+# Fixed prompt shape, built once: only the user turn changes per call
+_SYS = {"role": "system", "content": QA_RUBRIC}
+_USER_TEMPL = "Transcript:\n{}"
+_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "qa", "schema": QA_SCHEMA, "strict": True}
+}
+
+# Everything that shapes a verdict; part of the analysis cache key so prompt/model/routing edits invalidate it
+_ANALYSIS_FINGERPRINT = hashlib.sha256(orjson.dumps([
+    QA_RUBRIC, _USER_TEMPL, QA_SCHEMA, ANALYSIS_MODEL, LOCAL_LLM_PATH, LOCAL_LLM_MAX_WORDS
+])).hexdigest()
+
+async_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+queue = Queue(connection=Redis.from_url(REDIS_URL))
+
+# Shared HTTP client: keep-alive + pooled connections across downloads
+http_client = httpx.AsyncClient(
+    timeout=60,
+    follow_redirects=True,
+    limits=httpx.Limits(max_connections=DOWNLOAD_WORKERS)
+)
+
+for folder in ("recordings", "transcripts", "qa_reports", "reports", RECORDING_REPORTS_DIR, ANALYSIS_CACHE_DIR):
+    os.makedirs(folder, exist_ok=True)
+
+# Transcripts compress ~5-10x; stored as transcripts/{call_id}.txt.zst
+ZSTD_COMPRESSOR = zstd.ZstdCompressor(level=3)
+
+_report_lock = threading.Lock()
+_loop = None
+
+# -----------------------------------
+# 2. Helper Functions
+# -----------------------------------
+
+def run_async(coro):
+    """Run a coroutine on this process's event loop so the shared async clients stay on one loop"""
+    global _loop
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+    try:
+        return _loop.run_until_complete(coro)
+    except BaseException:
+        # e.g. RQ's JobTimeoutException: cancel this job's leftover tasks so they can't resume inside the next job
+        pending = asyncio.all_tasks(_loop)
+        for task in pending:
+            task.cancel()
+        _loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        raise
+
+
+@contextmanager
+def report_lock():
+    """Serialize appends to the shared CSV report across threads and worker processes"""
+    with _report_lock, open(f"{REPORT_CSV}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def recording_key(recording_url):
+    """SHA-256 of the recording URL (stable across webhook retries)"""
+    return hashlib.sha256(recording_url.encode("utf-8")).hexdigest()
+
+
+def recording_report_path(recording_url):
+    """Path of the finished result for a recording URL"""
+    return f"{RECORDING_REPORTS_DIR}/{recording_key(recording_url)}.json"
+
+
+def claim_recording(recording_url, job_id):
+    """Claim a recording URL for job_id; returns the id of the job already holding it, or None once claimed"""
+    key = f"qa:dedupe:{recording_key(recording_url)}"
+    while not queue.connection.set(key, job_id, nx=True, ex=DEDUPE_CLAIM_SECONDS):
+        existing = queue.connection.get(key)
+        if existing is not None:
+            return existing.decode("utf-8")
+        # Claim expired between SET and GET: try again
+    return None
+
+
+def release_recording(recording_url):
+    """Drop a recording's claim so a redelivered webhook can queue it again"""
+    queue.connection.delete(f"qa:dedupe:{recording_key(recording_url)}")
+
+
+def cached_report(recording_url):
+    """Return the saved QA result for an already processed recording, or None"""
+    path = recording_report_path(recording_url)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return orjson.loads(f.read())
+
+
+def write_atomic(path, data):
+    """Write text or bytes via temp file + rename so readers never see a half-written file"""
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def read_transcript(path):
+    """Load a saved transcript, decompressing zstd files on the fly"""
+    with open(path, "rb") as f:
+        data = f.read()
+    if path.endswith(".zst"):
+        data = zstd.ZstdDecompressor().decompress(data)
+    return data.decode("utf-8")
+
+
+async def download_recording(url, call_id, to_disk=False):
+    """Download a recording into memory, or straight to recordings/ when to_disk is set"""
+    file_path = f"recordings/{call_id}.mp3"
+    print(f"🎧 Downloading: {url}")
+    async with http_client.stream("GET", url) as r:
+        r.raise_for_status()
+        if to_disk:
+            with open(file_path, "wb") as f:
+                async for chunk in r.aiter_bytes(1 << 20):
+                    f.write(chunk)
+        else:
+            # Named buffer: Whisper uploads and faster-whisper both accept file-like audio
+            buf = io.BytesIO()
+            buf.name = f"{call_id}.mp3"
+            async for chunk in r.aiter_bytes(1 << 20):
+                buf.write(chunk)
+            buf.seek(0)
+            if SAVE_RECORDINGS:
+                write_atomic(file_path, buf.getvalue())
+    print("✅ Recording downloaded successfully")
+    return file_path if to_disk else buf
+
+
+def open_audio(audio_file):
+    """Open a recording given as a path or an in-memory buffer"""
+    if isinstance(audio_file, str):
+        return open(audio_file, "rb")
+    audio_file.seek(0)
+    return nullcontext(audio_file)
+
+
+async def batch_download(recordings):
+    """Download many (url, call_id) recordings concurrently over the shared client"""
+    semaphore = asyncio.Semaphore(DOWNLOAD_WORKERS)
+
+    async def fetch(url, call_id):
+        async with semaphore:
+            try:
+                return call_id, await download_recording(url, call_id, to_disk=True)
+            except Exception as e:
+                print(f"❌ Download failed for {call_id}:", e)
+                return call_id, None
+
+    results = await asyncio.gather(*(fetch(url, call_id) for url, call_id in recordings))
+    return {call_id: path for call_id, path in results if path}
+
+
+@functools.lru_cache(maxsize=1)
+def load_whisper_pipeline():
+    """Load faster-whisper once per worker process (only for TRANSCRIBE_BACKEND=local)"""
+    from faster_whisper import WhisperModel, BatchedInferencePipeline
+
+    print(f"🧠 Loading Whisper model: {WHISPER_MODEL} ({WHISPER_DEVICE}, {WHISPER_COMPUTE_TYPE})")
+    model = WhisperModel(
+        WHISPER_MODEL,
+        device=WHISPER_DEVICE,
+        compute_type=WHISPER_COMPUTE_TYPE,
+        num_workers=TRANSCRIBE_CONCURRENCY
+    )
+    return BatchedInferencePipeline(model=model)
+
+
+def transcribe_local(audio_file):
+    """Transcribe with faster-whisper; VAD splits the call into chunks decoded batch_size at a time"""
+    segments, _ = load_whisper_pipeline().transcribe(
+        audio_file, batch_size=WHISPER_BATCH_SIZE, vad_filter=True
+    )
+    return "".join(segment.text for segment in segments).strip()
+
+
+async def transcribe_audio(audio_file):
+    """Convert speech to text using OpenAI Whisper or a local faster-whisper model"""
+    print(f"🔊 Transcribing: {getattr(audio_file, 'name', audio_file)}")
+    if TRANSCRIBE_BACKEND == "local":
+        # CTranslate2 releases the GIL, so concurrent threads share the GPU
+        text = await asyncio.to_thread(transcribe_local, audio_file)
+    else:
+        with open_audio(audio_file) as f:
+            transcript = await async_client.audio.transcriptions.create(model="whisper-1", file=f)
+        text = transcript.text
+    print("📝 Transcription complete")
+    return text
+
+
+async def transcribe_many(audio_files):
+    """Transcribe {key: audio} concurrently, TRANSCRIBE_CONCURRENCY at a time, yielding (key, text) as each finishes"""
+    semaphore = asyncio.Semaphore(TRANSCRIBE_CONCURRENCY)
+
+    async def transcribe_one(key, audio_file):
+        async with semaphore:
+            try:
+                return key, await transcribe_audio(audio_file)
+            except Exception as e:
+                print(f"❌ Transcription failed for {audio_file}:", e)
+                return key, None
+
+    for next_done in asyncio.as_completed([transcribe_one(k, f) for k, f in audio_files.items()]):
+        yield await next_done
+
+
+def normalize_transcript(transcript):
+    """Lowercase and collapse whitespace so repeated scripted calls share a cache key"""
+    return " ".join(transcript.lower().split())
+
+
+@functools.lru_cache(maxsize=1)
+def load_local_llm():
+    """Load the quantized local scoring model once per worker process"""
+    from llama_cpp import Llama
+
+    print(f"🧠 Loading local LLM: {LOCAL_LLM_PATH}")
+    return Llama(model_path=LOCAL_LLM_PATH, n_ctx=4096, n_threads=os.cpu_count(), verbose=False)
+
+
+def analyze_local(transcript):
+    """Score a short call on the local model; returns None if its output is unusable"""
+    response = load_local_llm().create_chat_completion(
+        messages=[_SYS, {"role": "user", "content": _USER_TEMPL.format(transcript)}],
+        response_format={"type": "json_object", "schema": QA_SCHEMA},
+        temperature=0
+    )
+    try:
+        result = orjson.loads(response["choices"][0]["message"]["content"])
+        score = int(result["score"])
+        feedback = str(result["feedback"])
+    except (ValueError, KeyError, TypeError):
+        return None
+    if not 0 <= score <= 100:
+        return None
+    return {"score": score, "feedback": feedback}
+
+
+async def analyze_call(transcript):
+    """Analyze call and return {score, feedback} (cached per prompt setup + normalized transcript)"""
+    key = hashlib.sha256(f"{_ANALYSIS_FINGERPRINT}:{normalize_transcript(transcript)}".encode("utf-8")).hexdigest()
+    cache_path = f"{ANALYSIS_CACHE_DIR}/{key}.json"
+    try:
+        age_days = (time.time() - os.path.getmtime(cache_path)) / 86400
+    except FileNotFoundError:
+        age_days = None
+    if age_days is not None and age_days < ANALYSIS_CACHE_TTL_DAYS:
+        with open(cache_path, "rb") as f:
+            print("⚡ Analysis served from cache")
+            return orjson.loads(f.read())
+
+    # Short calls go to the local model first; long or unparseable ones escalate to GPT
+    if LOCAL_LLM_PATH and len(transcript.split()) < LOCAL_LLM_MAX_WORDS:
+        print("🤖 Analyzing call locally...")
+        result = await asyncio.to_thread(analyze_local, transcript)
+        if result is not None:
+            write_atomic(cache_path, orjson.dumps(result))
+            print("📊 Analysis complete (local)")
+            return result
+        print("↪️ Local analysis unusable, escalating to GPT")
+
+    print("🤖 Analyzing call...")
+    # Constant rubric first, transcript last: keeps the prefix eligible for OpenAI prompt caching
+    response = await async_client.chat.completions.create(
+        model=ANALYSIS_MODEL,
+        messages=[_SYS, {"role": "user", "content": _USER_TEMPL.format(transcript)}],
+        response_format=_RESPONSE_FORMAT
+    )
+    choice = response.choices[0]
+    if choice.message.refusal:
+        raise RuntimeError(f"Analysis refused by model: {choice.message.refusal}")
+    if choice.finish_reason != "stop":
+        raise RuntimeError(f"Analysis incomplete (finish_reason={choice.finish_reason})")
+    result = orjson.loads(choice.message.content)
+
+    usage = response.usage
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", 0) or 0
+    print(f"🧾 Prompt tokens: {usage.prompt_tokens} ({cached_tokens} cached)")
+
+    write_atomic(cache_path, orjson.dumps(result))
+
+    print("📊 Analysis complete")
+    return result
+
+
+def update_excel(call_id, agent_name, score, feedback, transcript_path):
+    """Append one row to the QA report log (exported to Excel on demand)"""
+    row = [
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        call_id,
+        agent_name,
+        score,
+        feedback,
+        transcript_path
+    ]
+
+    # Append under the lock before the job reports success, so a finished job's row is on disk
+    with report_lock(), open(REPORT_CSV, "a", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        if os.fstat(f.fileno()).st_size == 0:
+            writer.writerow(REPORT_COLUMNS)
+        writer.writerow(row)
+
+    print(f"📈 Report updated → {REPORT_CSV}")
+
+
+def import_legacy_report():
+    """One-time import of the old reports/QA_Report.xlsx into the CSV log, ahead of any newer rows"""
+    if not os.path.exists(LEGACY_REPORT_XLSX):
+        return
+    with report_lock():
+        # Another process may have imported it while we waited for the lock
+        if not os.path.exists(LEGACY_REPORT_XLSX):
+            return
+        from openpyxl import load_workbook
+
+        wb = load_workbook(LEGACY_REPORT_XLSX, read_only=True)
+        legacy_rows = list(wb.active.iter_rows(min_row=2, values_only=True))
+        wb.close()
+
+        newer_rows = []
+        if os.path.exists(REPORT_CSV):
+            with open(REPORT_CSV, newline="", encoding="utf-8") as f:
+                newer_rows = list(csv.reader(f))[1:]
+
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(REPORT_COLUMNS)
+        writer.writerows(legacy_rows)
+        writer.writerows(newer_rows)
+        write_atomic(REPORT_CSV, buf.getvalue())
+        os.replace(LEGACY_REPORT_XLSX, f"{LEGACY_REPORT_XLSX}.imported")
+    print(f"📥 Imported {len(legacy_rows)} rows from {LEGACY_REPORT_XLSX}")
+
+
+import_legacy_report()
+
+
+async def callyzer_get(path, params=None):
+    """Optional: Pull history from Callyzer Sandbox"""
+    url = f"{CALLYZER_BASE}{path}"
+    headers = {
+        "Authorization": f"Bearer {CALLYZER_KEY}",
+        "Content-Type": "application/json"
+    }
+    r = await http_client.get(url, headers=headers, params=params or {})
+    r.raise_for_status()
+    return orjson.loads(r.content)
+
+# -----------------------------------
+# 3. Background Jobs (Main Pipeline)
+# -----------------------------------
+
+def process_call(data):
+    """Run the full QA pipeline for one webhook payload"""
+    try:
+        return run_async(process_call_async(data))
+    except BaseException:
+        # Failed or timed out: let Callyzer's retry queue the recording again
+        release_recording(data["recording_url"])
+        raise
+
+
+async def process_call_async(data):
+    # Redelivered webhook for a recording we already scored: nothing to do
+    cached = cached_report(data["recording_url"])
+    if cached:
+        print(f"♻️ Duplicate recording, reusing report for {cached['call_id']}")
+        return cached
+
+    # Step 1: Download recording
+    audio_file = await download_recording(data["recording_url"], data["call_id"])
+
+    # Step 2: Transcribe
+    transcript_text = await transcribe_audio(audio_file)
+    return await report_call_async(data, transcript_text)
+
+
+def report_call(data, transcript_text):
+    """Analyze a transcript and save its QA report"""
+    return run_async(report_call_async(data, transcript_text))
+
+
+async def report_call_async(data, transcript_text):
+    call_id = data["call_id"]
+    agent_name = data["agent_name"]
+
+    # Step 3: Save transcript first, so a failed analysis doesn't lose the paid-for Whisper output
+    transcript_path = f"transcripts/{call_id}.txt.zst"
+    write_atomic(transcript_path, ZSTD_COMPRESSOR.compress(transcript_text.encode("utf-8")))
+
+    # Step 4: Analyze (schema-enforced JSON → score + feedback) & save report
+    analysis = await analyze_call(transcript_text)
+    score = analysis["score"]
+    feedback = analysis["feedback"]
+
+    # Per-call files need no lock: write_atomic's rename makes each write all-or-nothing
+    report_path = f"qa_reports/{call_id}.json"
+    write_atomic(report_path, orjson.dumps({"score": score, "feedback": feedback}, option=orjson.OPT_INDENT_2))
+
+    # Step 5: Update Excel
+    update_excel(call_id, agent_name, score, feedback, transcript_path)
+
+    # Mark the recording done only once its report row is on disk
+    result = {"call_id": call_id, "score": score, "feedback": feedback}
+    write_atomic(recording_report_path(data["recording_url"]), orjson.dumps(result))
+
+    print(f"✅ QA Report Generated: {call_id}")
+    return result
+
+
+def reprocess_range(start_date, end_date):
+    """Re-run QA for every Callyzer call in a date range (admin job: splits the range into batches)"""
+    return run_async(reprocess_range_async(start_date, end_date))
+
+
+async def reprocess_range_async(start_date, end_date):
+    history = await callyzer_get(CALLYZER_HISTORY_PATH, params={"start_date": start_date, "end_date": end_date})
+    calls = [
+        {
+            "call_id": str(item.get("call_id")),
+            "agent_name": item.get("agent_name") or "Unknown Agent",
+            "recording_url": item["recording_url"]
+        }
+        for item in history.get("data", [])
+        if item.get("call_id") and item.get("recording_url")
+    ]
+    print(f"🔁 Reprocessing {len(calls)} calls from {start_date} to {end_date}")
+
+    # Small sub-jobs: a timeout or crash only loses one batch, and batches spread across workers
+    batches = [calls[i:i + REPROCESS_BATCH_SIZE] for i in range(0, len(calls), REPROCESS_BATCH_SIZE)]
+    for batch in batches:
+        queue.enqueue(reprocess_batch, batch, job_timeout=1800)
+
+    return {"found": len(calls), "batches": len(batches)}
+
+
+def reprocess_batch(calls):
+    """Download and transcribe one batch of historical calls, queueing GPT analysis per call"""
+    return run_async(reprocess_batch_async(calls))
+
+
+async def reprocess_batch_async(calls):
+    by_id = {c["call_id"]: c for c in calls}
+    downloaded = await batch_download([(c["recording_url"], c["call_id"]) for c in calls])
+
+    # Overlap transcriptions in this worker; hand each transcript to the queue as soon as it lands
+    queued = 0
+    async for call_id, transcript_text in transcribe_many(downloaded):
+        if transcript_text is not None:
+            queue.enqueue(report_call, by_id[call_id], transcript_text, job_timeout=900)
+            queued += 1
+
+    return {"found": len(calls), "queued": queued}